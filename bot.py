@@ -1,7 +1,9 @@
 import os
+import asyncio
 import logging
 from datetime import datetime
-from typing import Optional, Set
+from functools import lru_cache
+from typing import Dict, Optional, Set, Tuple
 
 from aiogram import Bot, Dispatcher, types
 from aiogram.utils import executor
@@ -12,8 +14,8 @@ from aiogram.types import (
     ParseMode, InlineKeyboardMarkup, InlineKeyboardButton, BotCommand,
     ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
 )
+from cachetools import TTLCache
 from dotenv import load_dotenv
-import requests
 import db
 
 # load .env
@@ -33,14 +35,6 @@ except Exception:
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 logger = logging.getLogger(__name__)
 
-# optional quick token check (won't stop startup if fails, but warns)
-try:
-    r = requests.get(f"https://api.telegram.org/bot{TOKEN}/getMe", timeout=5)
-    if r.status_code != 200 or not r.json().get("ok"):
-        logger.warning("Telegram token check failed (getMe returned not ok).")
-except Exception:
-    logger.warning("Не удалось проверить токен у Telegram (продолжаем).")
-
 bot = Bot(token=TOKEN)
 dp = Dispatcher(bot, storage=MemoryStorage())
 
@@ -60,9 +54,35 @@ LANG_BUTTONS = [
     ("LT", "🇱🇹"), ("LV", "🇱🇻"), ("GE", "🇬🇪"), ("MD", "🇲🇩"),
 ]
 LANG_EMOJI = {code.upper(): emoji for code, emoji in LANG_BUTTONS}
-
-# In-memory viewing contexts per viewer (resets on bot restart)
-view_contexts = {}
+LANG_CODES = frozenset(code for code, _ in LANG_BUTTONS)
+
+# Canonical form input -> stored value, so common answers skip parsing
+_AR_STRINGS = {str(i): str(i) for i in range(1, 61)}
+
+def _playtime_strings() -> Dict[str, str]:
+    table = {"MSK": "MSK+0"}
+    for off in range(-12, 15):
+        sign = f"+{off}" if off >= 0 else str(off)
+        for key in (str(off), sign, f"MSK{sign}"):
+            table[key] = f"MSK{sign}"
+    return table
+
+_PLAYTIME_STRINGS = _playtime_strings()
+
+class ViewContextCache(TTLCache):
+    """TTLCache that logs when a viewing context is evicted for capacity."""
+
+    def popitem(self):
+        key, value = super().popitem()
+        logger.debug("Evicted view context for %s", key)
+        return key, value
+
+# In-memory viewing contexts per viewer (resets on bot restart); idle ones expire after an hour
+view_contexts = ViewContextCache(maxsize=50000, ttl=3600)
+# Cached profile counts per server; cleared whenever a profile is saved or deleted
+server_count_cache: Dict[str, int] = {}
+# Short-lived profile cache keyed by tg_id; see invalidate_profile()
+_profile_cache = TTLCache(maxsize=10000, ttl=60)
 # In-memory convenience to prevent duplicates in runtime if needed (not primary store)
 # but actual persistence of likes is in DB (db.likes table).
 # liked_pairs kept optionally – not strictly necessary, but we can omit to rely on DB.
@@ -86,12 +106,13 @@ def servers_keyboard(prefix: str = "server"):
         kb.insert(InlineKeyboardButton(label, callback_data=f"{prefix}:{key}"))
     return kb
 
+# (code, base label, callback data) for the language buttons
+_LANG_BUTTON_LABELS = [(code, f"{emoji} {code}", f"lang:{code}") for code, emoji in LANG_BUTTONS]
+
 def languages_keyboard(selected: Set[str]):
-    def label(code, emoji, sel_set):
-        return f"{emoji} {code}" + (" ✅" if code in sel_set else "")
     kb = InlineKeyboardMarkup(row_width=3)
-    for code, emoji in LANG_BUTTONS:
-        kb.insert(InlineKeyboardButton(label(code, emoji, selected), callback_data=f"lang:{code}"))
+    for code, label, cb_data in _LANG_BUTTON_LABELS:
+        kb.insert(InlineKeyboardButton((label + " ✅") if code in selected else label, callback_data=cb_data))
     kb.row(InlineKeyboardButton("Готово", callback_data="lang:DONE"))
     return kb
 
@@ -110,6 +131,15 @@ def main_menu_keyboard():
     kb.row(KeyboardButton("Смотреть анкеты"), KeyboardButton("Моя анкета"))
     return kb
 
+# Static keyboards are built once and shared (aiogram does not mutate markups on send)
+SERVER_KB_CREATE = servers_keyboard("server")
+SERVER_KB_BROWSE = servers_keyboard("browse_server")
+MAIN_MENU_KB = main_menu_keyboard()
+ACTION_KB = reply_action_keyboard()
+PROFILE_KB = InlineKeyboardMarkup()
+PROFILE_KB.add(InlineKeyboardButton("Удалить анкету", callback_data="profile:delete"))
+PROFILE_KB.add(InlineKeyboardButton("Редактировать", callback_data="profile:edit"))
+
 def get_owner_id(profile: dict) -> Optional[int]:
     for key in ("tg_id", "owner_id", "user_id", "id"):
         v = profile.get(key)
@@ -120,50 +150,125 @@ def get_owner_id(profile: dict) -> Optional[int]:
                 continue
     return None
 
+# memoized per raw languages value: the same few combinations are rendered over and over
+@lru_cache(maxsize=2048)
 def format_language_flags(langs_raw: str) -> str:
     if not langs_raw:
         return ""
-    parts = [p.strip().upper() for p in langs_raw.split(",") if p.strip()]
-    emojis = []
-    for p in parts:
-        em = LANG_EMOJI.get(p)
-        emojis.append(em if em else p)
-    return " ".join(emojis)
+    return " ".join(LANG_EMOJI.get(p, p) for p in (s.strip().upper() for s in langs_raw.split(",")) if p)
+
+async def get_server_count(server: str) -> int:
+    total = server_count_cache.get(server)
+    if total is None:
+        total = await db.count_profiles(server)
+        server_count_cache[server] = total
+    return total
+
+async def cached_get_profile(tg_id: int) -> Optional[dict]:
+    prof = _profile_cache.get(tg_id)
+    if prof is None:
+        prof = await db.get_profile_by_tg(tg_id)
+        if prof is not None:
+            _profile_cache[tg_id] = prof
+    return prof
+
+async def has_profile(tg_id: int) -> bool:
+    # presence check only: a cached profile answers it, otherwise select a single column
+    if tg_id in _profile_cache:
+        return True
+    return await db.profile_exists(tg_id)
+
+def invalidate_profile(tg_id: int):
+    # call after a profile is saved or deleted
+    _profile_cache.pop(tg_id, None)
+    server_count_cache.clear()
+
+async def send_action_keyboard(chat_id: int, prev_kb_msg_id: Optional[int] = None) -> Optional[int]:
+    # send the new action keyboard and delete the previous one concurrently
+    kb_msg, _ = await asyncio.gather(
+        bot.send_message(chat_id, "Действия (используйте кнопки ниже):", reply_markup=ACTION_KB),
+        bot.delete_message(chat_id, prev_kb_msg_id) if prev_kb_msg_id else asyncio.sleep(0),
+        return_exceptions=True,
+    )
+    if isinstance(kb_msg, BaseException):
+        logger.warning("Failed to send action keyboard to %s: %s", chat_id, kb_msg)
+        return None
+    return kb_msg.message_id
+
+def selected_languages(data: dict) -> list:
+    # the form keeps the selection as a sorted list; the comma-joined
+    # "languages" string (e.g. from a profile being edited) is parsed only until then
+    langs = data.get("languages_set")
+    if langs is None:
+        langs = sorted({p.strip().upper() for p in (data.get("languages", "") or "").split(",") if p.strip()})
+    return langs
+
+def profile_text(prof: dict, own: bool = False) -> str:
+    # own=True renders the owner's view (with header and server)
+    langs_flags = format_language_flags(prof.get("languages", "") or "")
+    header = f"Ваша анкета:\n\nСервер: {prof.get('server')}\n" if own else ""
+    return (
+        f"{header}"
+        f"Ник: {prof.get('nickname')}\n"
+        f"UID: {prof.get('uid')}\n"
+        f"AR: {prof.get('adventure_rank')}\n"
+        f"Языки: {langs_flags}\n"
+        f"Часовой пояс (от MSK): {prof.get('playtime')}\n"
+        f"О себе: {prof.get('bio')}\n"
+        f"Лайков: {prof.get('likes_count', 0)}\n"
+    )
+
+# ---------------- background notifications ----------------
+
+# strong refs so fire-and-forget tasks aren't garbage-collected mid-flight
+_background_tasks: Set[asyncio.Task] = set()
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+async def _notify_owner(owner_id: int, liker_name: str):
+    try:
+        await bot.send_message(owner_id, f"Ваша анкета получила лайк от {liker_name}.")
+    except Exception as e:
+        logger.warning("Failed to notify owner %s about a like (maybe blocked the bot): %s", owner_id, e)
+
+async def _forward_complaint(dev_msg: str, kb: Optional[InlineKeyboardMarkup], reporter_info: str):
+    try:
+        await bot.send_message(DEVELOPER_ID_INT, dev_msg, reply_markup=kb)
+        logger.info("Complaint forwarded to developer %s by %s", DEVELOPER_ID_INT, reporter_info)
+    except Exception:
+        logger.exception("Failed to forward complaint to developer.")
 
 # ---------------- core flow ----------------
 
-async def send_profile_with_actions(viewer_id: int, server: str, offset: int):
-    total = await db.count_profiles(server)
+async def send_profile_with_actions(viewer_id: int, server: str, cursor: Optional[Tuple[str, int]] = None, seen_count: int = 0, total: Optional[int] = None):
+    # total is counted once per browsing session and then carried in view_contexts
+    if total is None:
+        total = await get_server_count(server)
     if total == 0:
         await bot.send_message(viewer_id, f"Анкет на сервере {server} ещё нет.")
-        await bot.send_message(viewer_id, "Меню:", reply_markup=main_menu_keyboard())
+        await bot.send_message(viewer_id, "Меню:", reply_markup=MAIN_MENU_KB)
         return
 
-    # clamp offset
-    if offset < 0:
-        offset = 0
-    if offset >= total:
-        offset = total - 1
-
-    profiles = await db.list_profiles(server, limit=1, offset=offset)
+    # keyset cursor (created_at, id) of the last profile shown; None starts from the newest
+    after_created_at, after_id = cursor if cursor else (None, None)
+    profiles = await db.list_profiles(server, limit=1, after_created_at=after_created_at, after_id=after_id)
     if not profiles:
-        await bot.send_message(viewer_id, "Ошибка загрузки анкеты.")
+        prev_ctx = view_contexts.pop(viewer_id, None)
+        kb_msg_id = prev_ctx.get("keyboard_message_id") if prev_ctx else None
+        if kb_msg_id:
+            try:
+                await bot.delete_message(viewer_id, kb_msg_id)
+            except Exception:
+                pass
+        await bot.send_message(viewer_id, "Больше анкет нет. Просмотр остановлен.", reply_markup=MAIN_MENU_KB)
         return
 
     prof = profiles[0]
     owner_id = get_owner_id(prof)
-    like_num = await db.get_likes_count(owner_id) if owner_id else 0
-    langs_flags = format_language_flags(prof.get("languages", "") or "")
-
-    text = (
-        f"Ник: {prof.get('nickname')}\n"
-        f"UID: {prof.get('uid')}\n"
-        f"AR: {prof.get('adventure_rank')}\n"
-        f"Языки: {langs_flags}\n"
-        f"Часовой пояс (от MSK): {prof.get('playtime')}\n"
-        f"О себе: {prof.get('bio')}\n"
-        f"Лайков: {like_num}\n"
-    )
+    text = profile_text(prof)
 
     profile_id = prof.get("id") or owner_id or ""
     inline_kb = InlineKeyboardMarkup().add(
@@ -175,31 +280,25 @@ async def send_profile_with_actions(viewer_id: int, server: str, offset: int):
     prev_ctx = view_contexts.get(viewer_id)
     prev_kb_msg_id = prev_ctx.get("keyboard_message_id") if prev_ctx else None
 
-    kb_msg = await bot.send_message(viewer_id, "Действия (используйте кнопки ниже):", reply_markup=reply_action_keyboard())
-
-    if prev_kb_msg_id:
-        try:
-            await bot.delete_message(viewer_id, prev_kb_msg_id)
-        except Exception:
-            pass
+    kb_msg_id = await send_action_keyboard(viewer_id, prev_kb_msg_id)
 
     view_contexts[viewer_id] = {
         "server": server,
-        "offset": offset,
+        "cursor": (prof["created_at"], prof["id"]),
+        "seen_count": seen_count + 1,
         "total": total,
         "owner_id": owner_id,
         "profile_id": profile_id,
-        "keyboard_message_id": kb_msg.message_id,
+        "keyboard_message_id": kb_msg_id,
         "profile_message_id": profile_msg.message_id,
     }
-    logger.info("Stored context for %s: server=%s offset=%s owner=%s", viewer_id, server, offset, owner_id)
+    logger.info("Stored context for %s: server=%s profile_id=%s owner=%s", viewer_id, server, prof["id"], owner_id)
 
 # ---------------- handlers ----------------
 
 @dp.message_handler(commands=["start", "help"])
 async def cmd_start(message: types.Message):
-    prof = await db.get_profile_by_tg(message.from_user.id)
-    if prof:
+    if await has_profile(message.from_user.id):
         kb = InlineKeyboardMarkup()
         kb.add(
             InlineKeyboardButton("Показать мою анкету", callback_data="profile:view"),
@@ -210,12 +309,12 @@ async def cmd_start(message: types.Message):
         await message.answer("У вас уже есть сохранённая анкета. Что вы хотите сделать?", reply_markup=kb)
         return
 
-    await message.answer("Привет! Я бот для поиска тиммейтов по Genshin.\nСначала выберите сервер:", reply_markup=servers_keyboard(prefix="server"))
+    await message.answer("Привет! Я бот для поиска тиммейтов по Genshin.\nСначала выберите сервер:", reply_markup=SERVER_KB_CREATE)
     await Form.choosing_server.set()
 
 @dp.message_handler(commands=["edit"])
 async def cmd_edit(message: types.Message, state: FSMContext):
-    prof = await db.get_profile_by_tg(message.from_user.id)
+    prof = await cached_get_profile(message.from_user.id)
     if not prof:
         await message.answer("Анкета не найдена. Создать: /start")
         return
@@ -224,10 +323,9 @@ async def cmd_edit(message: types.Message, state: FSMContext):
     await message.answer(f"Редактирование анкеты. Текущий ник: {current_nick}\nВведите новый ник (или отправьте '-' чтобы оставить текущий):")
     await Form.nickname.set()
 
-@dp.callback_query_handler(lambda c: c.data == "profile:edit")
 async def profile_edit_callback(callback_query: types.CallbackQuery, state: FSMContext):
     await bot.answer_callback_query(callback_query.id)
-    prof = await db.get_profile_by_tg(callback_query.from_user.id)
+    prof = await cached_get_profile(callback_query.from_user.id)
     if not prof:
         await bot.send_message(callback_query.from_user.id, "Анкета не найдена. Создать: /start")
         return
@@ -241,56 +339,35 @@ async def profile_edit_callback(callback_query: types.CallbackQuery, state: FSMC
     await bot.send_message(callback_query.from_user.id, f"Редактирование анкеты. Текущий ник: {current_nick}\nВведите новый ник (или отправьте '-' чтобы оставить текущий):")
     await Form.nickname.set()
 
-@dp.callback_query_handler(lambda c: c.data == "profile:cancel")
-async def profile_cancel(callback_query: types.CallbackQuery):
+async def profile_cancel(callback_query: types.CallbackQuery, state: FSMContext):
     await bot.answer_callback_query(callback_query.id, text="Отменено.")
 
-@dp.callback_query_handler(lambda c: c.data == "profile:view")
-async def profile_view(callback_query: types.CallbackQuery):
+async def profile_view(callback_query: types.CallbackQuery, state: FSMContext):
     await bot.answer_callback_query(callback_query.id)
-    prof = await db.get_profile_by_tg(callback_query.from_user.id)
+    prof = await cached_get_profile(callback_query.from_user.id)
     if not prof:
         await bot.send_message(callback_query.from_user.id, "Анкета не найдена.")
         return
-    owner_id = get_owner_id(prof)
-    like_num = await db.get_likes_count(owner_id) if owner_id else 0
-    langs_flags = format_language_flags(prof.get("languages", "") or "")
-    text = (
-        f"Ваша анкета:\n\n"
-        f"Сервер: {prof.get('server')}\n"
-        f"Ник: {prof.get('nickname')}\n"
-        f"UID: {prof.get('uid')}\n"
-        f"AR: {prof.get('adventure_rank')}\n"
-        f"Языки: {langs_flags}\n"
-        f"Часовой пояс (от MSK): {prof.get('playtime')}\n"
-        f"О себе: {prof.get('bio')}\n"
-        f"Лайков: {like_num}\n"
-    )
-    kb = InlineKeyboardMarkup()
-    kb.add(InlineKeyboardButton("Удалить анкету", callback_data="profile:delete"))
-    kb.add(InlineKeyboardButton("Редактировать", callback_data="profile:edit"))
-    await bot.send_message(callback_query.from_user.id, text, reply_markup=kb)
+    await bot.send_message(callback_query.from_user.id, profile_text(prof, own=True), reply_markup=PROFILE_KB)
 
-@dp.callback_query_handler(lambda c: c.data and c.data.startswith("complain:"))
-async def handle_complain(callback_query: types.CallbackQuery):
+async def handle_complain(callback_query: types.CallbackQuery, state: FSMContext):
     await bot.answer_callback_query(callback_query.id, text="Жалоба зарегистрирована. Спасибо.")
-    parts = callback_query.data.split(":", 2)
-    if len(parts) < 3:
+    _, _, rest = callback_query.data.partition(":")
+    owner_part, sep, profile_part = rest.partition(":")
+    if not sep:
         logger.warning("Invalid complain callback data: %s", callback_query.data)
         return
-    owner_part = parts[1]
-    profile_part = parts[2]
     reporter = callback_query.from_user
     reporter_info = f"{reporter.full_name} (id={reporter.id})"
 
     profile_info = ""
     try:
-        owner_id = int(owner_part) if owner_part and str(owner_part).isdigit() else None
-    except Exception:
+        owner_id = int(owner_part)
+    except (TypeError, ValueError):
         owner_id = None
 
-    if owner_id:
-        prof = await db.get_profile_by_tg(owner_id)
+    if owner_id is not None:
+        prof = await cached_get_profile(owner_id)
         if prof:
             langs_flags = format_language_flags(prof.get("languages", "") or "")
             profile_info = (
@@ -311,20 +388,15 @@ async def handle_complain(callback_query: types.CallbackQuery):
 
     # Add inline delete button for developer convenience
     kb = InlineKeyboardMarkup()
-    if owner_part and str(owner_part).isdigit():
-        kb.add(InlineKeyboardButton("Удалить анкету (DEV)", callback_data=f"dev:delete:{owner_part}"))
+    if owner_id is not None:
+        kb.add(InlineKeyboardButton("Удалить анкету (DEV)", callback_data=f"dev:delete:{owner_id}"))
 
     if DEVELOPER_ID_INT:
-        try:
-            await bot.send_message(DEVELOPER_ID_INT, dev_msg, reply_markup=kb if kb.inline_keyboard else None)
-            logger.info("Complaint forwarded to developer %s by %s", DEVELOPER_ID_INT, reporter_info)
-        except Exception:
-            logger.exception("Failed to forward complaint to developer.")
+        run_in_background(_forward_complaint(dev_msg, kb if kb.inline_keyboard else None, reporter_info))
     else:
         logger.warning("Developer ID not configured; complaint: %s", dev_msg)
 
-@dp.callback_query_handler(lambda c: c.data == "profile:delete")
-async def profile_delete_request(callback_query: types.CallbackQuery):
+async def profile_delete_request(callback_query: types.CallbackQuery, state: FSMContext):
     await bot.answer_callback_query(callback_query.id)
     kb = InlineKeyboardMarkup()
     kb.add(
@@ -333,21 +405,19 @@ async def profile_delete_request(callback_query: types.CallbackQuery):
     )
     await bot.send_message(callback_query.from_user.id, "Вы уверены, что хотите удалить вашу анкету? Это действие нельзя отменить.", reply_markup=kb)
 
-@dp.callback_query_handler(lambda c: c.data == "profile:delete_confirm")
-async def profile_delete_confirm(callback_query: types.CallbackQuery):
+async def profile_delete_confirm(callback_query: types.CallbackQuery, state: FSMContext):
     await bot.answer_callback_query(callback_query.id)
     await db.delete_profile(callback_query.from_user.id)
+    invalidate_profile(callback_query.from_user.id)
     await bot.send_message(callback_query.from_user.id, "Ваша анкета удалена.")
     await bot.send_message(callback_query.from_user.id, "Если хотите создать новую анкету — используйте /start")
 
-@dp.callback_query_handler(lambda c: c.data == "profile:delete_cancel")
-async def profile_delete_cancel(callback_query: types.CallbackQuery):
+async def profile_delete_cancel(callback_query: types.CallbackQuery, state: FSMContext):
     await bot.answer_callback_query(callback_query.id, text="Удаление отменено.")
     await bot.send_message(callback_query.from_user.id, "Удаление отменено. Ваша анкета сохранена.")
 
-@dp.callback_query_handler(lambda c: c.data and c.data.startswith("server:"), state=Form.choosing_server)
 async def process_server_with_state(callback_query: types.CallbackQuery, state: FSMContext):
-    server = callback_query.data.split(":",1)[1]
+    _, _, server = callback_query.data.partition(":")
     await state.update_data(server=server)
     await bot.answer_callback_query(callback_query.id, text=f"Сервер {server} выбран")
     try:
@@ -384,6 +454,8 @@ async def process_ar(message: types.Message, state: FSMContext):
     if not (txt == "-" and editing):
         if txt == "-":
             await state.update_data(adventure_rank="")
+        elif txt in _AR_STRINGS:
+            await state.update_data(adventure_rank=_AR_STRINGS[txt])
         else:
             try:
                 ar = int(txt)
@@ -394,7 +466,7 @@ async def process_ar(message: types.Message, state: FSMContext):
                 await message.answer("AR вне допустимого диапазона. Введите число от 1 до 60 или '-' для пропуска/сохранения:")
                 return
             await state.update_data(adventure_rank=str(ar))
-    selected = set([p.strip().upper() for p in (data.get("languages","") or "").split(",") if p.strip()])
+    selected = set(selected_languages(data))
     kb = languages_keyboard(selected)
     prompt = "Выберите языки (нажмите кнопки, чтобы отметить/снять):"
     if editing:
@@ -402,19 +474,16 @@ async def process_ar(message: types.Message, state: FSMContext):
     await message.answer(prompt, reply_markup=kb)
     await Form.languages.set()
 
-@dp.callback_query_handler(lambda c: c.data and c.data.startswith("lang:"), state=Form.languages)
 async def process_lang_toggle(callback_query: types.CallbackQuery, state: FSMContext):
-    action = callback_query.data.split(":",1)[1]
+    _, _, action = callback_query.data.partition(":")
     data = await state.get_data()
-    langs_raw = data.get("languages", "") or ""
-    selected = set([p.strip().upper() for p in langs_raw.split(",") if p.strip()])
-    codes = {code for code, _ in LANG_BUTTONS}
-    if action in codes:
+    selected = set(selected_languages(data))
+    if action in LANG_CODES:
         if action in selected:
             selected.remove(action)
         else:
             selected.add(action)
-        await state.update_data(languages=",".join(sorted(selected)))
+        await state.update_data(languages_set=sorted(selected))
         kb = languages_keyboard(selected)
         try:
             await bot.edit_message_text(chat_id=callback_query.from_user.id, message_id=callback_query.message.message_id, text="Выберите языки (нажмите кнопки, чтобы отметить/снять):", reply_markup=kb)
@@ -441,6 +510,8 @@ async def process_playtime(message: types.Message, state: FSMContext):
     if not (txt == "-" and editing):
         if txt == "-":
             await state.update_data(playtime="")
+        elif txt in _PLAYTIME_STRINGS:
+            await state.update_data(playtime=_PLAYTIME_STRINGS[txt])
         else:
             val = txt.upper().replace(" ", "")
             parsed = None
@@ -479,8 +550,9 @@ async def process_bio(message: types.Message, state: FSMContext):
     data = await state.get_data()
     editing = data.get("editing", False)
     if not (txt == "-" and editing):
-        await state.update_data(bio=txt[:500])
-    data = await state.get_data()
+        new_bio = txt[:500]
+        data["bio"] = new_bio
+        await state.update_data(bio=new_bio)
     preview_playtime = data.get('playtime', '')
     preview = (
         f"Анкета (предпросмотр):\n\n"
@@ -488,7 +560,7 @@ async def process_bio(message: types.Message, state: FSMContext):
         f"Ник: {data.get('nickname')}\n"
         f"UID: {data.get('uid')}\n"
         f"AR: {data.get('adventure_rank')}\n"
-        f"Языки: {format_language_flags(data.get('languages','') or '')}\n"
+        f"Языки: {format_language_flags(','.join(selected_languages(data)))}\n"
         f"Часовой пояс (от MSK): {preview_playtime}\n"
         f"О себе: {data.get('bio')}\n"
     )
@@ -498,18 +570,19 @@ async def process_bio(message: types.Message, state: FSMContext):
     await message.answer(preview, reply_markup=kb)
     await Form.confirm.set()
 
-@dp.callback_query_handler(lambda c: c.data and c.data.startswith("confirm:"), state=Form.confirm)
 async def process_confirm(callback_query: types.CallbackQuery, state: FSMContext):
-    choice = callback_query.data.split(":",1)[1]
+    _, _, choice = callback_query.data.partition(":")
     await bot.answer_callback_query(callback_query.id)
     if choice == "yes":
         data = await state.get_data()
-        data_to_save = {k: v for k, v in data.items() if k != "editing"}
+        data_to_save = {k: v for k, v in data.items() if k not in ("editing", "languages_set")}
+        data_to_save["languages"] = ",".join(selected_languages(data))
         if "platforms" not in data_to_save:
             data_to_save["platforms"] = ""
         if "playstyle" not in data_to_save:
             data_to_save["playstyle"] = ""
         await db.save_profile(callback_query.from_user.id, data_to_save)
+        invalidate_profile(callback_query.from_user.id)
         await bot.send_message(callback_query.from_user.id, "Анкета сохранена! Используйте /search чтобы просматривать анкеты.")
         await state.finish()
     else:
@@ -519,13 +592,12 @@ async def process_confirm(callback_query: types.CallbackQuery, state: FSMContext
 # Search flow
 @dp.message_handler(commands=["search"])
 async def cmd_search(message: types.Message):
-    await message.answer("Выберите сервер для просмотра анкет:", reply_markup=servers_keyboard(prefix="browse_server"))
+    await message.answer("Выберите сервер для просмотра анкет:", reply_markup=SERVER_KB_BROWSE)
 
-@dp.callback_query_handler(lambda c: c.data and c.data.startswith("browse_server:"))
-async def process_browse_server(callback_query: types.CallbackQuery):
-    server = callback_query.data.split(":",1)[1]
+async def process_browse_server(callback_query: types.CallbackQuery, state: FSMContext):
+    _, _, server = callback_query.data.partition(":")
     await bot.answer_callback_query(callback_query.id)
-    await send_profile_with_actions(callback_query.from_user.id, server, 0)
+    await send_profile_with_actions(callback_query.from_user.id, server, total=None)
 
 # Actions: Like / Message / Dislike / Stop
 @dp.message_handler(lambda m: m.text in ("👍 Лайк", "✉️ Письмо", "👎 Дизлайк", "⏹️ Стоп"))
@@ -538,7 +610,8 @@ async def handle_action_message(message: types.Message, state: FSMContext):
         return
 
     server = ctx["server"]
-    offset = ctx["offset"]
+    cursor = ctx["cursor"]
+    seen_count = ctx["seen_count"]
     total = ctx["total"]
     owner_id = ctx["owner_id"]
 
@@ -549,23 +622,22 @@ async def handle_action_message(message: types.Message, state: FSMContext):
         if owner_id == user_id:
             await message.answer("Нельзя лайкать свою анкету.")
             return
-        already = await db.has_liked(user_id, owner_id)
-        if already:
+        # add_like reports duplicates itself, so no separate has_liked round-trip
+        inserted = await db.add_like(user_id, owner_id)
+        if inserted is None:
+            await message.answer("Эта анкета уже удалена.")
+            return
+        if not inserted:
             await message.answer("Вы уже ставили лайк этой анкете ранее.")
             return
-        inserted = await db.add_like(user_id, owner_id)
-        if inserted:
-            liker = message.from_user
-            liker_name = liker.username and f"@{liker.username}" or liker.full_name
-            try:
-                await bot.send_message(owner_id, f"Ваша анкета получила лайк от {liker_name}.")
-                await message.answer("Лайк отправлен и владелец уведомлён. Переходим к следующей анкете.", reply_markup=ReplyKeyboardRemove())
-            except Exception:
-                await message.answer("Лайк учтён, но не удалось уведомить владельца (возможно, он заблокировал бота). Переходим к следующей анкете.", reply_markup=ReplyKeyboardRemove())
-        else:
-            await message.answer("Не удалось поставить лайк (возможно, вы уже ставили).", reply_markup=ReplyKeyboardRemove())
-        next_offset = offset + 1
-        if next_offset >= total:
+        # the owner's cached profile carries the old likes_count
+        _profile_cache.pop(owner_id, None)
+        liker = message.from_user
+        liker_name = liker.username and f"@{liker.username}" or liker.full_name
+        # the liker doesn't wait for the owner's notification
+        run_in_background(_notify_owner(owner_id, liker_name))
+        await message.answer("Лайк отправлен. Переходим к следующей анкете.", reply_markup=ReplyKeyboardRemove())
+        if seen_count >= total:
             kb_msg_id = ctx.get("keyboard_message_id")
             if kb_msg_id:
                 try:
@@ -573,14 +645,13 @@ async def handle_action_message(message: types.Message, state: FSMContext):
                 except Exception:
                     pass
             view_contexts.pop(user_id, None)
-            await bot.send_message(user_id, "Больше анкет нет. Просмотр остановлен.", reply_markup=main_menu_keyboard())
+            await bot.send_message(user_id, "Больше анкет нет. Просмотр остановлен.", reply_markup=MAIN_MENU_KB)
             return
-        await send_profile_with_actions(user_id, server, next_offset)
+        await send_profile_with_actions(user_id, server, cursor, seen_count, total=total)
         return
 
     if cmd == "👎 Дизлайк":
-        next_offset = offset + 1
-        if next_offset >= total:
+        if seen_count >= total:
             kb_msg_id = ctx.get("keyboard_message_id")
             if kb_msg_id:
                 try:
@@ -588,9 +659,9 @@ async def handle_action_message(message: types.Message, state: FSMContext):
                 except Exception:
                     pass
             view_contexts.pop(user_id, None)
-            await bot.send_message(user_id, "Это была последняя анкета. Просмотр остановлен.", reply_markup=main_menu_keyboard())
+            await bot.send_message(user_id, "Это была последняя анкета. Просмотр остановлен.", reply_markup=MAIN_MENU_KB)
             return
-        await send_profile_with_actions(user_id, server, next_offset)
+        await send_profile_with_actions(user_id, server, cursor, seen_count, total=total)
         return
 
     if cmd == "✉️ Письмо":
@@ -613,7 +684,7 @@ async def handle_action_message(message: types.Message, state: FSMContext):
             except Exception:
                 pass
         view_contexts.pop(user_id, None)
-        await bot.send_message(user_id, "Просмотр остановлен.", reply_markup=main_menu_keyboard())
+        await bot.send_message(user_id, "Просмотр остановлен.", reply_markup=MAIN_MENU_KB)
         return
 
 @dp.message_handler(state=Form.sending_message)
@@ -626,16 +697,9 @@ async def handle_sending_message(message: types.Message, state: FSMContext):
         await state.finish()
         ctx = view_contexts.get(message.from_user.id)
         if ctx:
-            kb_msg = await bot.send_message(message.from_user.id, "Действия (используйте кнопки ниже):", reply_markup=reply_action_keyboard())
-            prev_kb = ctx.get("keyboard_message_id")
-            if prev_kb:
-                try:
-                    await bot.delete_message(message.from_user.id, prev_kb)
-                except Exception:
-                    pass
-            ctx["keyboard_message_id"] = kb_msg.message_id
+            ctx["keyboard_message_id"] = await send_action_keyboard(message.from_user.id, ctx.get("keyboard_message_id"))
         else:
-            await bot.send_message(message.from_user.id, "Меню:", reply_markup=main_menu_keyboard())
+            await bot.send_message(message.from_user.id, "Меню:", reply_markup=MAIN_MENU_KB)
         return
     if not target_id:
         await message.answer("Не удалось найти получателя. Отмена.")
@@ -652,118 +716,75 @@ async def handle_sending_message(message: types.Message, state: FSMContext):
         await message.answer("Не удалось отправить сообщение владельцу (возможно, он заблокировал бота).")
     ctx = view_contexts.get(message.from_user.id)
     if ctx:
-        kb_msg = await bot.send_message(message.from_user.id, "Действия (используйте кнопки ниже):", reply_markup=reply_action_keyboard())
-        prev_kb = ctx.get("keyboard_message_id")
-        if prev_kb:
-            try:
-                await bot.delete_message(message.from_user.id, prev_kb)
-            except Exception:
-                pass
-        ctx["keyboard_message_id"] = kb_msg.message_id
+        ctx["keyboard_message_id"] = await send_action_keyboard(message.from_user.id, ctx.get("keyboard_message_id"))
     else:
-        await bot.send_message(message.from_user.id, "Меню:", reply_markup=main_menu_keyboard())
+        await bot.send_message(message.from_user.id, "Меню:", reply_markup=MAIN_MENU_KB)
     await state.finish()
 
 @dp.message_handler(lambda m: m.text == "Смотреть анкеты")
 async def menu_watch_profiles(message: types.Message):
-    await message.answer("Выберите сервер для просмотра анкет:", reply_markup=servers_keyboard(prefix="browse_server"))
+    await message.answer("Выберите сервер для просмотра анкет:", reply_markup=SERVER_KB_BROWSE)
 
 @dp.message_handler(lambda m: m.text == "Моя анкета")
 async def menu_my_profile(message: types.Message):
-    prof = await db.get_profile_by_tg(message.from_user.id)
+    prof = await cached_get_profile(message.from_user.id)
     if not prof:
-        await message.answer("Анкета не найдена. Создать: /start", reply_markup=main_menu_keyboard())
+        await message.answer("Анкета не найдена. Создать: /start", reply_markup=MAIN_MENU_KB)
         return
-    owner_id = get_owner_id(prof)
-    like_num = await db.get_likes_count(owner_id) if owner_id else 0
-    langs_flags = format_language_flags(prof.get("languages", "") or "")
-    text = (
-        f"Ваша анкета:\n\n"
-        f"Сервер: {prof.get('server')}\n"
-        f"Ник: {prof.get('nickname')}\n"
-        f"UID: {prof.get('uid')}\n"
-        f"AR: {prof.get('adventure_rank')}\n"
-        f"Языки: {langs_flags}\n"
-        f"Часовой пояс (от MSK): {prof.get('playtime')}\n"
-        f"О себе: {prof.get('bio')}\n"
-        f"Лайков: {like_num}\n"
-    )
-    kb = InlineKeyboardMarkup()
-    kb.add(InlineKeyboardButton("Удалить анкету", callback_data="profile:delete"))
-    kb.add(InlineKeyboardButton("Редактировать", callback_data="profile:edit"))
-    await message.answer(text, reply_markup=kb)
+    await message.answer(profile_text(prof, own=True), reply_markup=PROFILE_KB)
 
 @dp.message_handler(commands=["myprofile"])
 async def cmd_myprofile(message: types.Message):
-    prof = await db.get_profile_by_tg(message.from_user.id)
+    prof = await cached_get_profile(message.from_user.id)
     if not prof:
         await message.answer("Анкета не найдена. Создать: /start")
         return
-    owner_id = get_owner_id(prof)
-    like_num = await db.get_likes_count(owner_id) if owner_id else 0
-    langs_flags = format_language_flags(prof.get("languages", "") or "")
-    text = (
-        f"Ваша анкета:\n\n"
-        f"Сервер: {prof.get('server')}\n"
-        f"Ник: {prof.get('nickname')}\n"
-        f"UID: {prof.get('uid')}\n"
-        f"AR: {prof.get('adventure_rank')}\n"
-        f"Языки: {langs_flags}\n"
-        f"Часовой пояс (от MSK): {prof.get('playtime')}\n"
-        f"О себе: {prof.get('bio')}\n"
-        f"Лайков: {like_num}\n"
-    )
-    kb = InlineKeyboardMarkup()
-    kb.add(InlineKeyboardButton("Удалить анкету", callback_data="profile:delete"))
-    kb.add(InlineKeyboardButton("Редактировать", callback_data="profile:edit"))
-    await message.answer(text, reply_markup=kb)
+    await message.answer(profile_text(prof, own=True), reply_markup=PROFILE_KB)
 
-@dp.message_handler(commands=["delete_profile"])
 async def cmd_delete_profile(message: types.Message):
-    # developer-only command to delete profile
-    if DEVELOPER_ID_INT is None or message.from_user.id != DEVELOPER_ID_INT:
-        await message.reply("Команда доступна только разработчику.")
-        return
-    parts = message.text.strip().split()
-    if len(parts) < 2:
+    # developer-only command to delete profile (registered with a user_id filter below)
+    target_raw, _, _ = message.get_args().strip().partition(" ")
+    if not target_raw:
         await message.reply("Использование: /delete_profile <tg_id>")
         return
     try:
-        target_id = int(parts[1])
+        target_id = int(target_raw)
     except Exception:
         await message.reply("Неверный tg_id.")
         return
     await db.delete_profile(target_id)
+    invalidate_profile(target_id)
     await message.reply(f"Анкета {target_id} удалена.")
     try:
         await bot.send_message(target_id, "Ваша анкета была удалена администратором.")
     except Exception:
         pass
 
+# dev-only: other users' /delete_profile never reaches the handler
+if DEVELOPER_ID_INT is not None:
+    dp.register_message_handler(cmd_delete_profile, commands=["delete_profile"], user_id=DEVELOPER_ID_INT)
+
 @dp.message_handler(commands=["cancel"])
 async def cmd_cancel(message: types.Message, state: FSMContext):
     await state.finish()
     await message.answer("Операция отменена.", reply_markup=ReplyKeyboardRemove())
 
-@dp.callback_query_handler(lambda c: c.data and c.data.startswith("dev:delete:"))
-async def dev_delete_profile_callback(callback_query: types.CallbackQuery):
-    # защита: только разработчик
-    if DEVELOPER_ID_INT is None or callback_query.from_user.id != DEVELOPER_ID_INT:
-        await bot.answer_callback_query(callback_query.id, text="Нет доступа")
-        return
-
-    parts = callback_query.data.split(":")
-    if len(parts) != 3:
+async def dev_delete_profile_callback(callback_query: types.CallbackQuery, state: FSMContext):
+    # only dispatched for the developer (see DEV_CB_DISPATCH)
+    _, _, rest = callback_query.data.partition(":")
+    action, sep, target_raw = rest.partition(":")
+    if action != "delete" or not sep:
         await bot.answer_callback_query(callback_query.id, text="Ошибка данных")
         return
 
     try:
-        target_id = int(parts[2])
+        target_id = int(target_raw)
     except ValueError:
         await bot.answer_callback_query(callback_query.id, text="Неверный tg_id")
         return
 
     await db.delete_profile(target_id)
+    invalidate_profile(target_id)
 
     await bot.answer_callback_query(callback_query.id, text="Анкета удалена")
 
@@ -780,12 +801,65 @@ async def dev_delete_profile_callback(callback_query: types.CallbackQuery):
     except Exception:
         pass
 
+# ---------------- callback dispatch ----------------
+
+# profile:<action> callbacks
+PROFILE_CB_DISPATCH = {
+    "edit": profile_edit_callback,
+    "cancel": profile_cancel,
+    "view": profile_view,
+    "delete": profile_delete_request,
+    "delete_confirm": profile_delete_confirm,
+    "delete_cancel": profile_delete_cancel,
+}
+
+async def handle_profile_cb(callback_query: types.CallbackQuery, state: FSMContext):
+    _, _, action = callback_query.data.partition(":")
+    handler = PROFILE_CB_DISPATCH.get(action)
+    if handler:
+        await handler(callback_query, state)
+
+# callback data prefix -> (handler, FSM state the handler is active in; None = no state)
+CB_DISPATCH = {
+    "profile": (handle_profile_cb, None),
+    "complain": (handle_complain, None),
+    "server": (process_server_with_state, Form.choosing_server.state),
+    "browse_server": (process_browse_server, None),
+    "lang": (process_lang_toggle, Form.languages.state),
+    "confirm": (process_confirm, Form.confirm.state),
+}
+
+# developer-only prefixes, dispatched only when the callback comes from DEVELOPER_ID_INT
+DEV_CB_DISPATCH = {"dev": dev_delete_profile_callback} if DEVELOPER_ID_INT is not None else {}
+
+@dp.callback_query_handler(state="*")
+async def dispatch_callback(callback_query: types.CallbackQuery, state: FSMContext):
+    prefix, _, _ = (callback_query.data or "").partition(":")
+    entry = CB_DISPATCH.get(prefix)
+    if entry is None:
+        handler = DEV_CB_DISPATCH.get(prefix)
+        if handler and callback_query.from_user.id == DEVELOPER_ID_INT:
+            await handler(callback_query, state)
+        return
+    handler, required_state = entry
+    if await state.get_state() != required_state:
+        return
+    await handler(callback_query, state)
+
 # ---------------- startup/shutdown ----------------
 
 async def on_startup(_):
-    # Initialize DB (creates profiles and likes tables if not exist)
+    # Open the DB connection pool and initialize DB (creates profiles and likes tables if not exist)
+    await db.init_pool()
     await db.init_db()
+    db.start_likes_writer()
     logger.info("DB initialized and bot started")
+    # optional quick token check (won't stop startup if fails, but warns)
+    try:
+        me = await bot.get_me()
+        logger.info("Bot @%s", me.username)
+    except Exception:
+        logger.warning("Не удалось проверить токен у Telegram (продолжаем).")
     try:
         commands = [
             BotCommand(command="start", description="Начать / создать анкету"),
@@ -796,5 +870,12 @@ async def on_startup(_):
     except Exception as e:
         logger.warning("Не удалось установить команды бота: %s", e)
 
+async def on_shutdown(_):
+    try:
+        await db.optimize()
+    except Exception as e:
+        logger.warning("PRAGMA optimize failed: %s", e)
+    await db.close_pool()
+
 if __name__ == "__main__":
-    executor.start_polling(dp, on_startup=on_startup, skip_updates=True)
\ No newline at end of file
+    executor.start_polling(dp, on_startup=on_startup, on_shutdown=on_shutdown, skip_updates=True)
\ No newline at end of file
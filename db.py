@@ -1,8 +1,24 @@
 import aiosqlite
-import datetime
+import asyncio
+import os
+import sqlite3
+from contextlib import asynccontextmanager
 from typing import Optional, List, Dict, Any
 
 DB_PATH = "profiles.db"
+# number of warm connections kept open for handlers
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+
+# likes are coalesced: add_like() queues them and one writer task commits each burst together
+LIKES_FLUSH_INTERVAL = 0.02  # seconds to let a burst accumulate
+LIKES_BATCH_MAX = 200
+
+# INSERT ... RETURNING (likes writer) needs 3.35; this also covers UPSERT (3.24) and row values (3.15)
+SQLITE_MIN_VERSION = (3, 35, 0)
+
+_pool: Optional[asyncio.Queue] = None
+_likes_queue: Optional[asyncio.Queue] = None
+_likes_writer_task: Optional[asyncio.Task] = None
 
 CREATE_TABLE_SQL = """
 CREATE TABLE IF NOT EXISTS profiles (
@@ -17,7 +33,8 @@ CREATE TABLE IF NOT EXISTS profiles (
     platforms TEXT,
     playtime TEXT,
     bio TEXT,
-    created_at TEXT DEFAULT CURRENT_TIMESTAMP
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+    likes_count INTEGER NOT NULL DEFAULT 0
 );
 """
 
@@ -26,120 +43,310 @@ CREATE_LIKES_SQL = """
 CREATE TABLE IF NOT EXISTS likes (
     owner_id INTEGER NOT NULL,
     viewer_id INTEGER NOT NULL,
-    created_at TEXT NOT NULL,
+    created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
     PRIMARY KEY (owner_id, viewer_id),
     FOREIGN KEY (owner_id) REFERENCES profiles(tg_id) ON DELETE CASCADE
 );
 """
 
+# keep profiles.likes_count in sync with the likes table
+CREATE_LIKES_TRIGGERS_SQL = (
+    """
+    CREATE TRIGGER IF NOT EXISTS likes_ai AFTER INSERT ON likes BEGIN
+        UPDATE profiles SET likes_count = likes_count + 1 WHERE tg_id = NEW.owner_id;
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS likes_ad AFTER DELETE ON likes BEGIN
+        UPDATE profiles SET likes_count = likes_count - 1 WHERE tg_id = OLD.owner_id;
+    END;
+    """,
+)
+
+# ---------------- Connection pool ----------------
+
+# applied to every pooled connection right after it is opened
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    # only enforces the likes FK where the table was created with it; older likes tables have none
+    "PRAGMA foreign_keys=ON",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=134217728",  # 128 MiB
+    "PRAGMA cache_size=-20000",  # ~20 MB page cache
+)
+
+async def _connect() -> aiosqlite.Connection:
+    conn = await aiosqlite.connect(DB_PATH)
+    # rows support name lookup, so dict(row) converts without a key list
+    conn.row_factory = aiosqlite.Row
+    for pragma in CONNECTION_PRAGMAS:
+        await conn.execute(pragma)
+    return conn
+
+async def init_pool(size: int = DB_POOL_SIZE) -> None:
+    """
+    Open `size` connections up front so handlers reuse them instead of connecting per call.
+    """
+    global _pool
+    if _pool is not None:
+        return
+    pool = asyncio.Queue()
+    for _ in range(max(1, size)):
+        pool.put_nowait(await _connect())
+    _pool = pool
+
+async def close_pool() -> None:
+    # flush queued likes before their connections go away
+    await stop_likes_writer()
+    global _pool
+    pool, _pool = _pool, None
+    while pool is not None and not pool.empty():
+        conn = pool.get_nowait()
+        await conn.close()
+
+@asynccontextmanager
+async def _acquire():
+    if _pool is None:
+        await init_pool()
+    pool = _pool
+    conn = await pool.get()
+    try:
+        yield conn
+    except BaseException:
+        # don't hand a connection with a half-done transaction to the next caller
+        await conn.rollback()
+        raise
+    finally:
+        pool.put_nowait(conn)
+
 async def init_db():
     """
-    Initialize DB: ensures profiles and likes tables exist.
+    Initialize DB: ensures profiles and likes tables exist (run after init_pool()).
+    Databases created before profiles.likes_count existed get the column added and backfilled.
+    Stops the bot if the sqlite3 library is older than SQLITE_MIN_VERSION.
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    if sqlite3.sqlite_version_info < SQLITE_MIN_VERSION:
+        raise SystemExit(
+            f"Нужен SQLite {'.'.join(map(str, SQLITE_MIN_VERSION))}+, а Python собран с SQLite {sqlite3.sqlite_version}."
+        )
+    async with _acquire() as db:
         await db.execute(CREATE_TABLE_SQL)
         await db.execute(CREATE_LIKES_SQL)
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_likes_owner ON likes(owner_id);")
+        # owner_id lookups use the (owner_id, viewer_id) primary key; drop the old duplicate index
+        await db.execute("DROP INDEX IF EXISTS idx_likes_owner;")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_profiles_server_created ON profiles(server, created_at DESC, id DESC);")
+        # likes tables from the old schema have no FK, so likes of deleted profiles may have been left behind
+        await db.execute("DELETE FROM likes WHERE owner_id NOT IN (SELECT tg_id FROM profiles)")
+        async with db.execute("PRAGMA table_info(profiles)") as cur:
+            columns = {row[1] for row in await cur.fetchall()}
+        if "likes_count" not in columns:
+            await db.execute("ALTER TABLE profiles ADD COLUMN likes_count INTEGER NOT NULL DEFAULT 0")
+            await db.execute("UPDATE profiles SET likes_count = (SELECT COUNT(*) FROM likes WHERE likes.owner_id = profiles.tg_id)")
+        for trigger_sql in CREATE_LIKES_TRIGGERS_SQL:
+            await db.execute(trigger_sql)
+        await db.commit()
+        # give the planner statistics: full ANALYZE the first time, then let optimize refresh them
+        async with db.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'") as cur:
+            has_stats = await cur.fetchone() is not None
+        if not has_stats:
+            await db.execute("ANALYZE")
+        await db.execute("PRAGMA optimize")
+        await db.commit()
+
+async def optimize() -> None:
+    """
+    Refresh query planner statistics where SQLite thinks they are stale (run on shutdown).
+    """
+    async with _acquire() as db:
+        await db.execute("PRAGMA optimize")
         await db.commit()
 
 # ---------------- Profiles API ----------------
 
 async def save_profile(tg_id: int, data: Dict[str, Any]) -> None:
-    """Insert or update a profile (upsert)."""
-    now = datetime.datetime.utcnow().isoformat()
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT 1 FROM profiles WHERE tg_id = ? LIMIT 1", (tg_id,))
-        exists = await cur.fetchone()
-        await cur.close()
-        if exists:
-            await db.execute("""
-                UPDATE profiles
-                SET server=?, nickname=?, uid=?, adventure_rank=?, languages=?, playtime=?, bio=?, platforms=?, playstyle=?
-                WHERE tg_id=?
-            """, (
-                data.get("server",""), data.get("nickname",""), data.get("uid",""),
-                data.get("adventure_rank",""), data.get("languages",""), data.get("playtime",""),
-                data.get("bio",""), data.get("platforms",""), data.get("playstyle",""), tg_id
-            ))
-        else:
-            await db.execute("""
-                INSERT INTO profiles (tg_id, server, nickname, uid, adventure_rank, languages, playtime, bio, platforms, playstyle, created_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                tg_id, data.get("server",""), data.get("nickname",""), data.get("uid",""),
-                data.get("adventure_rank",""), data.get("languages",""), data.get("playtime",""),
-                data.get("bio",""), data.get("platforms",""), data.get("playstyle",""), now
-            ))
+    """Insert or update a profile (single-statement upsert; created_at is kept on update)."""
+    async with _acquire() as db:
+        await db.execute("""
+            INSERT INTO profiles (tg_id, server, nickname, uid, adventure_rank, languages, playtime, bio, platforms, playstyle)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(tg_id) DO UPDATE SET
+                server=excluded.server, nickname=excluded.nickname, uid=excluded.uid,
+                adventure_rank=excluded.adventure_rank, languages=excluded.languages, playtime=excluded.playtime,
+                bio=excluded.bio, platforms=excluded.platforms, playstyle=excluded.playstyle
+        """, (
+            tg_id, data.get("server",""), data.get("nickname",""), data.get("uid",""),
+            data.get("adventure_rank",""), data.get("languages",""), data.get("playtime",""),
+            data.get("bio",""), data.get("platforms",""), data.get("playstyle","")
+        ))
         await db.commit()
 
 async def get_profile_by_tg(tg_id: int) -> Optional[Dict[str, Any]]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("""
-            SELECT tg_id, server, nickname, uid, adventure_rank, playstyle, languages, platforms, playtime, bio, created_at
-            FROM profiles WHERE tg_id = ? LIMIT 1
-        """, (tg_id,))
-        row = await cur.fetchone()
-        await cur.close()
+    """
+    Profile including its likes count ("likes_count"), so views need a single query.
+    """
+    async with _acquire() as db:
+        async with db.execute("""
+                SELECT tg_id, server, nickname, uid, adventure_rank, playstyle, languages, platforms, playtime, bio, created_at, likes_count
+                FROM profiles WHERE tg_id = ? LIMIT 1
+            """, (tg_id,)) as cur:
+            row = await cur.fetchone()
         if not row:
             return None
-        keys = ["tg_id","server","nickname","uid","adventure_rank","playstyle","languages","platforms","playtime","bio","created_at"]
-        return dict(zip(keys, row))
+        return dict(row)
+
+async def profile_exists(tg_id: int) -> bool:
+    async with _acquire() as db:
+        async with db.execute("SELECT 1 FROM profiles WHERE tg_id = ? LIMIT 1", (tg_id,)) as cur:
+            row = await cur.fetchone()
+        return row is not None
 
 async def delete_profile(tg_id: int) -> None:
     """
-    Delete profile and cascade delete likes (owner likes) via FK.
+    Delete profile and the likes it received.
+    The likes are deleted explicitly: likes tables created by the old schema have no ON DELETE CASCADE.
     """
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _acquire() as db:
         await db.execute("DELETE FROM profiles WHERE tg_id = ?", (tg_id,))
+        await db.execute("DELETE FROM likes WHERE owner_id = ?", (tg_id,))
         await db.commit()
 
 async def count_profiles(server: str) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT COUNT(*) FROM profiles WHERE server = ?", (server,))
-        row = await cur.fetchone()
-        await cur.close()
+    async with _acquire() as db:
+        async with db.execute("SELECT COUNT(*) FROM profiles WHERE server = ?", (server,)) as cur:
+            row = await cur.fetchone()
         return int(row[0]) if row else 0
 
-async def list_profiles(server: str, limit: int = 10, offset: int = 0) -> List[Dict[str, Any]]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("""
-            SELECT tg_id, server, nickname, uid, adventure_rank, playstyle, languages, platforms, playtime, bio, created_at
-            FROM profiles
-            WHERE server = ?
-            ORDER BY created_at DESC
-            LIMIT ? OFFSET ?
-        """, (server, limit, offset))
-        rows = await cur.fetchall()
-        await cur.close()
-        keys = ["tg_id","server","nickname","uid","adventure_rank","playstyle","languages","platforms","playtime","bio","created_at"]
-        return [dict(zip(keys, r)) for r in rows]
+async def list_profiles(server: str, limit: int = 10, after_created_at: Optional[str] = None, after_id: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Newest-first page of profiles on a server. Pass the created_at/id of the last
+    row already shown to get the next page (keyset pagination: each page costs
+    O(limit), however deep the viewer has browsed).
+    Each row carries its likes count as "likes_count".
+    """
+    if after_created_at is None or after_id is None:
+        where, params = "p.server = ?", (server, limit)
+    else:
+        where, params = "p.server = ? AND (p.created_at, p.id) < (?, ?)", (server, after_created_at, after_id, limit)
+    async with _acquire() as db:
+        async with db.execute(f"""
+                SELECT p.id, p.tg_id, p.server, p.nickname, p.uid, p.adventure_rank, p.playstyle, p.languages, p.platforms, p.playtime, p.bio, p.created_at,
+                       p.likes_count
+                FROM profiles p
+                WHERE {where}
+                ORDER BY p.created_at DESC, p.id DESC
+                LIMIT ?
+            """, params) as cur:
+            rows = await cur.fetchall()
+        return [dict(r) for r in rows]
 
 # ---------------- Likes API (now in same DB) ----------------
 
-async def add_like(viewer_id: int, owner_id: int) -> bool:
+def start_likes_writer() -> None:
     """
-    Add like (owner_id — профиль получателя, viewer_id — кто лайкнул).
-    Returns True if inserted, False if already existed.
+    Start the background task that writes queued likes (no-op if it is already running).
+    """
+    global _likes_queue, _likes_writer_task
+    if _likes_writer_task is not None:
+        return
+    _likes_queue = asyncio.Queue()
+    _likes_writer_task = asyncio.get_event_loop().create_task(_likes_writer(_likes_queue))
+
+async def stop_likes_writer() -> None:
     """
-    created = datetime.datetime.utcnow().isoformat()
+    Write whatever is still queued and stop the writer task.
+    """
+    global _likes_queue, _likes_writer_task
+    task, queue = _likes_writer_task, _likes_queue
+    _likes_writer_task, _likes_queue = None, None
+    if task is None:
+        return
+    queue.put_nowait(None)
+    await task
+
+async def _likes_writer(queue: asyncio.Queue) -> None:
+    while True:
+        item = await queue.get()
+        if item is None:
+            return
+        await asyncio.sleep(LIKES_FLUSH_INTERVAL)
+        batch = [item]
+        stopping = False
+        while not queue.empty() and len(batch) < LIKES_BATCH_MAX:
+            item = queue.get_nowait()
+            if item is None:
+                stopping = True
+                break
+            batch.append(item)
+        await _write_likes(batch)
+        if stopping:
+            return
+
+async def _write_likes(batch: List[tuple]) -> None:
+    """
+    Insert a batch of (owner_id, viewer_id, future) with a single INSERT ... RETURNING and resolve
+    each future with True if its like was new, False if it already existed and None if the
+    profile is gone.
+    """
+    pairs = [(owner_id, viewer_id) for owner_id, viewer_id, _ in batch]
+    unique = list(dict.fromkeys(pairs))
+    missing_owners = set()
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute("INSERT INTO likes (owner_id, viewer_id, created_at) VALUES (?, ?, ?)", (owner_id, viewer_id, created))
+        async with _acquire() as db:
+            values = ", ".join("(?, ?)" for _ in unique)
+            # CURRENT_TIMESTAMP rather than the column default: older likes tables have none.
+            # Likes for a profile that no longer exists are filtered out instead of failing the batch.
+            async with db.execute(f"""
+                    INSERT OR IGNORE INTO likes (owner_id, viewer_id, created_at)
+                    SELECT column1, column2, CURRENT_TIMESTAMP FROM (VALUES {values})
+                    WHERE column1 IN (SELECT tg_id FROM profiles)
+                    RETURNING owner_id, viewer_id
+                """, [v for pair in unique for v in pair]) as cur:
+                inserted = {tuple(r) for r in await cur.fetchall()}
+            # only a like that wasn't inserted needs telling apart: duplicate or deleted profile
+            skipped_owners = list({owner_id for owner_id, viewer_id in unique if (owner_id, viewer_id) not in inserted})
+            if skipped_owners:
+                async with db.execute(
+                    f"SELECT tg_id FROM profiles WHERE tg_id IN ({', '.join('?' for _ in skipped_owners)})", skipped_owners
+                ) as cur:
+                    missing_owners = set(skipped_owners) - {r[0] for r in await cur.fetchall()}
             await db.commit()
-            return True
-    except aiosqlite.IntegrityError:
-        return False
+    except Exception as e:
+        for *_, fut in batch:
+            if not fut.done():
+                fut.set_exception(e)
+        return
+    # only the first request for a new pair reports True; repeats in the same burst are duplicates
+    for pair, (*_, fut) in zip(pairs, batch):
+        if pair[0] in missing_owners:
+            result = None
+        else:
+            result = pair in inserted
+            inserted.discard(pair)
+        if not fut.done():
+            fut.set_result(result)
+
+async def add_like(viewer_id: int, owner_id: int) -> Optional[bool]:
+    """
+    Add like (owner_id — профиль получателя, viewer_id — кто лайкнул).
+    Returns True if inserted, False if already existed, None if the owner's profile no longer exists.
+    The insert is committed together with other likes queued in the same burst.
+    """
+    start_likes_writer()
+    fut = asyncio.get_event_loop().create_future()
+    _likes_queue.put_nowait((owner_id, viewer_id, fut))
+    return await fut
 
 async def has_liked(viewer_id: int, owner_id: int) -> bool:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT 1 FROM likes WHERE viewer_id = ? AND owner_id = ? LIMIT 1", (viewer_id, owner_id))
-        row = await cur.fetchone()
-        await cur.close()
+    async with _acquire() as db:
+        # equality on both columns is served by the (owner_id, viewer_id) primary key
+        async with db.execute("SELECT 1 FROM likes WHERE owner_id = ? AND viewer_id = ? LIMIT 1", (owner_id, viewer_id)) as cur:
+            row = await cur.fetchone()
         return row is not None
 
 async def get_likes_count(owner_id: int) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT COUNT(*) FROM likes WHERE owner_id = ?", (owner_id,))
-        row = await cur.fetchone()
-        await cur.close()
+    # maintained by the likes_ai/likes_ad triggers
+    async with _acquire() as db:
+        async with db.execute("SELECT likes_count FROM profiles WHERE tg_id = ?", (owner_id,)) as cur:
+            row = await cur.fetchone()
         return int(row[0]) if row else 0
\ No newline at end of file